@@ -1,7 +1,7 @@
 import logging
 
 from .classes import QBTBatchMove, FastResume
-from .methods import discover_bt_backup_path, convert_slashes
+from .methods import discover_bt_backup_path, convert_slashes, slash_converter
 
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
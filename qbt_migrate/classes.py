@@ -1,96 +1,359 @@
 import os
+import re
+import errno
+import stat
+import asyncio
+import shutil
 import logging
 import zipfile
-from threading import Thread
+from collections import deque
+from functools import lru_cache, partial
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional, Pattern, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import bencode
 
-from .methods import discover_bt_backup_path, convert_slashes
+try:
+    import fastbencode
+except ImportError:
+    fastbencode = None
+
+from .methods import discover_bt_backup_path, slash_converter
 
 
 logger = logging.getLogger(__name__)
+DEFAULT_MAX_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+IO_BUFFER_SIZE = 128 * 1024
+
+
+# Fields we read and rewrite. fastbencode returns bytes for every string, so these are decoded
+# to str on load to match what bencode.py returns.
+_STR_FIELDS = ('save_path', 'qBt-savePath', 'mapped_files')
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    return value
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_bytes(item) for item in value]
+    return value
+
+
+def _bdecode(raw: bytes) -> dict:
+    if fastbencode is None:
+        return bencode.bdecode(raw)
+    data = fastbencode.bdecode(raw)
+    if not isinstance(data, dict):
+        return data
+    data = {key.decode('utf-8'): value for key, value in data.items()}
+    for key in _STR_FIELDS:
+        if key in data:
+            data[key] = _to_str(data[key])
+    return data
+
+
+def _bencode(data: dict) -> bytes:
+    if fastbencode is None:
+        return bencode.bencode(data)
+    return fastbencode.bencode({key.encode('utf-8'): _to_bytes(value) if key in _STR_FIELDS else value
+                                for key, value in data.items()})
+
+
+def _paired_paths(existing_path: Union[str, List[str]],
+                  new_path: Union[str, List[str]]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    existing_paths = (existing_path,) if isinstance(existing_path, str) else tuple(existing_path)
+    new_paths = (new_path,) if isinstance(new_path, str) else tuple(new_path)
+    if len(existing_paths) != len(new_paths):
+        raise ValueError('Each existing path must have a new path. '
+                         f'Received {len(existing_paths)} existing and {len(new_paths)} new paths')
+    if len(set(existing_paths)) != len(existing_paths):
+        raise ValueError(f'Each existing path can only be given once. Received {list(existing_paths)}')
+    return existing_paths, new_paths
+
+
+@lru_cache(maxsize=32)
+def _path_matcher(existing_paths: Tuple[str, ...]) -> Pattern[str]:
+    # Longest first, so overlapping paths (/mnt/disk1 vs /mnt/disk10) match the most specific one
+    return re.compile('|'.join(map(re.escape, sorted(existing_paths, key=len, reverse=True))))
+
+
+@lru_cache(maxsize=1024)
+def _replaced_save_path(save_path: str, existing_paths: Tuple[str, ...], new_paths: Tuple[str, ...],
+                        target_os: Optional[str] = None) -> Optional[str]:
+    # Most torrents share a handful of save paths, so the result is cached per distinct old save path.
+    # None means save_path contains none of existing_paths.
+    new_path_for = dict(zip(existing_paths, new_paths))
+    path, replaced = _path_matcher(existing_paths).subn(lambda match: new_path_for[match.group(0)], save_path)
+    if not replaced:
+        return None
+    if target_os is not None:
+        path = slash_converter(target_os)(path)
+    return path
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        return f.read()
+
+
+def _replace_file(path: str, data: bytes, sync: bool = False):
+    """
+    Atomically replace path with data, by writing a temporary file and renaming it over path.
+    On Linux the temporary file is created unnamed (O_TMPFILE) and only linked in once fully written,
+    so a crash can't leave a partially written temporary file behind. The data is only guaranteed to
+    survive a power loss with sync.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        original = os.stat(path)
+    except FileNotFoundError:
+        original = None
+    if not _link_tmpfile(tmp_path, data, original, sync):
+        with open(tmp_path, 'wb', buffering=max(IO_BUFFER_SIZE, len(data))) as f:
+            f.write(data)
+            if original is not None:
+                _copy_file_attributes(f.fileno(), original)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _copy_file_attributes(fd: int, original: os.stat_result):
+    """
+    Give a replacement file the mode and, where permitted, the owner of the file it replaces,
+    e.g. when running as root against another user's BT_backup.
+    """
+    if hasattr(os, 'fchmod'):
+        os.fchmod(fd, stat.S_IMODE(original.st_mode))
+    if hasattr(os, 'fchown'):
+        try:
+            os.fchown(fd, original.st_uid, original.st_gid)
+        except PermissionError:
+            pass
+
+
+# Cleared once O_TMPFILE or linking it in from /proc turns out to be unsupported
+_tmpfile_supported = hasattr(os, 'O_TMPFILE')
+# EXDEV is included as some sandboxes refuse links from /proc even within one filesystem
+_TMPFILE_UNSUPPORTED_ERRNOS = frozenset((errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL, errno.ENOENT, errno.EXDEV))
+
+
+def _link_tmpfile(path: str, data: bytes, original: Optional[os.stat_result] = None, sync: bool = False) -> bool:
+    global _tmpfile_supported
+    if not _tmpfile_supported:
+        return False
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_TMPFILE | os.O_WRONLY, 0o666)
+    except OSError as e:
+        if e.errno in _TMPFILE_UNSUPPORTED_ERRNOS:  # Filesystem doesn't support O_TMPFILE
+            _tmpfile_supported = False
+        return False
+    try:
+        with open(fd, 'wb', buffering=0, closefd=False) as f:
+            f.write(data)
+        if original is not None:
+            _copy_file_attributes(fd, original)
+        if sync:
+            os.fsync(fd)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        os.link('/proc/self/fd/%d' % fd, path)
+    except OSError as e:
+        if e.errno in _TMPFILE_UNSUPPORTED_ERRNOS:
+            _tmpfile_supported = False
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def _fsync_directory(path: str):
+    if not hasattr(os, 'O_DIRECTORY'):  # Windows
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 class QBTBatchMove(object):
     logger = logging.getLogger(__name__ + '.QBTBatchMove')
 
-    def __init__(self, bt_backup_path: str = None):
+    def __init__(self, bt_backup_path: str = None, max_workers: int = DEFAULT_MAX_WORKERS):
         if bt_backup_path is None:
             bt_backup_path = discover_bt_backup_path()
         self.logger.debug('BT_backup Path: %s' % bt_backup_path)
         self.bt_backup_path = bt_backup_path
+        self.max_workers = max_workers
         self.discovered_files = None
 
-    def run(self, existing_path: str, new_path: str, target_os: Optional[str] = None,
-            create_backup: bool = True, skip_bad_files: bool = False):
+    def run(self, existing_path: Union[str, List[str]], new_path: Union[str, List[str]],
+            target_os: Optional[str] = None, create_backup: bool = True, skip_bad_files: bool = False):
         """
         Perform Batch Processing of path changes.
-        :param existing_path: Existing path to look for
-        :type existing_path: str
-        :param new_path: New Path to replace with
-        :type new_path: str
+        Multiple existing paths can be migrated in a single pass over BT_backup by passing lists of paths.
+        :param existing_path: Existing path(s) to look for
+        :type existing_path: str or list[str]
+        :param new_path: New Path(s) to replace with, in the same order as existing_path
+        :type new_path: str or list[str]
         :param target_os: If targeting a different OS than the source. Must be Windows, Linux, or Mac.
         :type target_os: str
-        :param create_backup: Create a backup archive of the BT_Backup directory?
+        :param create_backup: Create a backup archive of the BT_Backup directory? Without one, each file is
+                              fsynced before it replaces the original.
         :type create_backup: bool
         :param skip_bad_files: Skip .fastresume files that cannot be read successfully.
         :type skip_bad_files: bool
         """
+        existing_paths, new_paths = _paired_paths(existing_path, new_path)
         if not os.path.exists(self.bt_backup_path) or not os.path.isdir(self.bt_backup_path):
             raise NotADirectoryError(self.bt_backup_path)
         if create_backup:
             backup_filename = 'fastresume_backup' + datetime.now().strftime('%Y%m%d%H%M%S') + '.zip'
             self.backup_folder(self.bt_backup_path,
-                               os.path.join(os.path.dirname(self.bt_backup_path), backup_filename))
+                               os.path.join(os.path.dirname(self.bt_backup_path), backup_filename),
+                               self.max_workers)
+
+        _replaced_save_path.cache_clear()
+        self.logger.info('Searching for .fastresume files with path %s ...' % ', '.join(existing_paths))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(fast_resume.replace_paths, existing_paths, new_paths,
+                                   target_os, True, False, not create_backup)
+                       for fast_resume in self.discover_relevant_fast_resume(self.bt_backup_path, existing_paths,
+                                                                             not skip_bad_files)]
+            for future in as_completed(futures):
+                future.result()
+        if not create_backup:
+            # Each file was fsynced before it was renamed into place, so the renames can be flushed
+            # once for the whole batch. Flushing them without the file data could leave empty files.
+            _fsync_directory(self.bt_backup_path)
 
-        self.logger.info('Searching for .fastresume files with path %s ...' % existing_path)
-        for fast_resume in self.discover_relevant_fast_resume(self.bt_backup_path, existing_path, not skip_bad_files):
-            # Fire and forget
-            Thread(target=fast_resume.replace_paths, args=[existing_path, new_path,
-                                                           target_os, True, False]).start()
+    async def run_async(self, existing_path: Union[str, List[str]], new_path: Union[str, List[str]],
+                        target_os: Optional[str] = None, create_backup: bool = True, skip_bad_files: bool = False):
+        """
+        Awaitable version of run, for use from within an asyncio event loop.
+        The batch runs on a worker thread so the event loop is not blocked; files are still
+        processed concurrently on a pool of max_workers threads.
+        :param existing_path: Existing path(s) to look for
+        :type existing_path: str or list[str]
+        :param new_path: New Path(s) to replace with, in the same order as existing_path
+        :type new_path: str or list[str]
+        :param target_os: If targeting a different OS than the source. Must be Windows, Linux, or Mac.
+        :type target_os: str
+        :param create_backup: Create a backup archive of the BT_Backup directory?
+        :type create_backup: bool
+        :param skip_bad_files: Skip .fastresume files that cannot be read successfully.
+        :type skip_bad_files: bool
+        """
+        await asyncio.get_event_loop().run_in_executor(
+            None, partial(self.run, existing_path, new_path, target_os, create_backup, skip_bad_files))
 
     @classmethod
-    def discover_relevant_fast_resume(cls, bt_backup_path: str, existing_path: str, raise_on_error: bool = True):
+    def discover_relevant_fast_resume(cls, bt_backup_path: str, existing_path: Union[str, List[str]],
+                                      raise_on_error: bool = True):
         """
-        Find .fastresume files that contain the existing path.
+        Find .fastresume files that contain the existing path, or any of several existing paths,
+        in a single pass over the folder.
         :param bt_backup_path: Path to BT_backup folder
         :type bt_backup_path: str
-        :param existing_path: The existing path to look for
-        :type existing_path: str
+        :param existing_path: The existing path(s) to look for
+        :type existing_path: str or list[str]
         :param raise_on_error: Raise if error parsing .fastresume files
         :type raise_on_error: bool
         :return: List of FastResume Objects
         :rtype: list[FastResume]
         """
-        for file in os.listdir(bt_backup_path):
-            if file.endswith('.fastresume'):
+        existing_paths = (existing_path,) if isinstance(existing_path, str) else tuple(existing_path)
+        matcher = _path_matcher(existing_paths)
+        raw_matcher = re.compile(b'|'.join(re.escape(path.encode('utf-8')) for path in existing_paths))
+        bt_backup_path = os.path.realpath(bt_backup_path)
+        with os.scandir(bt_backup_path) as it:
+            for entry in it:
+                if not entry.name.endswith('.fastresume') or not entry.is_file():
+                    continue
                 try:
-                    fast_resume = FastResume(os.path.join(bt_backup_path, file))
+                    # Bencoded strings are stored as raw bytes, so a file that doesn't contain an
+                    # existing path anywhere can't contain it in save_path or qBt-savePath either.
+                    raw = _read_bytes(entry.path)
+                    if raw_matcher.search(raw) is None:
+                        continue
+                    fast_resume = FastResume._from_scandir(entry, raw)
                 except (
                     bencode.exceptions.BencodeDecodeError,
-                    FileNotFoundError,
+                    OSError,
                     ValueError
                 ) as e:
                     if raise_on_error:
-                        cls.logger.critical(f'Unable to parse {file}. Stopping Discovery!')
+                        cls.logger.critical('Unable to parse %s. Stopping Discovery!', entry.name)
                         raise e
-                    cls.logger.warning(f'Unable to parse {file}. Skipping!\n\n{e}')
+                    cls.logger.warning('Unable to parse %s. Skipping!\n\n%s', entry.name, e)
                     continue
-                if existing_path in fast_resume.save_path or \
-                        existing_path in fast_resume.qbt_save_path:
+                if matcher.search(fast_resume.save_path) or matcher.search(fast_resume.qbt_save_path):
                     yield fast_resume
         return
 
     @classmethod
-    def backup_folder(cls, folder_path: str, archive_path: str):
+    def backup_folder(cls, folder_path: str, archive_path: str, max_workers: int = DEFAULT_MAX_WORKERS):
+        """
+        Create an uncompressed zip archive of a folder.
+        Files are read concurrently and written to the archive in order from the calling thread,
+        as ZipFile is not thread safe. The archive is fsynced before returning.
+        :param folder_path: Path to the folder to archive
+        :type folder_path: str
+        :param archive_path: Path of the zip archive to create
+        :type archive_path: str
+        :param max_workers: Maximum number of files to read concurrently
+        :type max_workers: int
+        """
         cls.logger.info(f'Creating Archive {archive_path} ...')
-        with zipfile.ZipFile(archive_path, 'w') as archive:
-            for file in os.listdir(folder_path):
-                archive.write(os.path.join(folder_path, file))
+        archive_name = None
+        if os.path.samefile(os.path.dirname(os.path.abspath(archive_path)), folder_path):
+            archive_name = os.path.basename(archive_path)
+        with open(archive_path, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_STORED) as archive, \
+                    ThreadPoolExecutor(max_workers=max_workers) as pool, \
+                    os.scandir(folder_path) as it:
+                pending = deque()
+                for entry in it:
+                    if entry.name == archive_name:
+                        continue
+                    if not entry.is_file():
+                        archive.write(entry.path)
+                        continue
+                    pending.append(pool.submit(cls._read_archive_member, entry.path))
+                    # Bound the number of files in flight at once
+                    if len(pending) >= max_workers * 2:
+                        archive.writestr(*pending.popleft().result())
+                while pending:
+                    archive.writestr(*pending.popleft().result())
+            # The archive must reach the disk before any of the files it backs up are rewritten
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_directory(os.path.dirname(os.path.abspath(archive_path)))
         cls.logger.info('Done!')
 
+    @staticmethod
+    def _read_archive_member(path: str):
+        zinfo = zipfile.ZipInfo.from_file(path)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+            return zinfo, f.read()
+
     @classmethod
     def update_fastresume(cls, fast_resume: 'FastResume', existing_path: str, new_path: str,
                           target_os: Optional[str] = None, save_file: bool = True, create_backup: bool = True):
@@ -104,11 +367,31 @@ class FastResume(object):
         self._file_path = os.path.realpath(file_path)
         if not os.path.exists(self.file_path) or not os.path.isfile(self.file_path):
             raise FileNotFoundError(self.file_path)
-        self.logger.debug(f'Loading Fast Resume: {self.file_path}')
-        self._data = bencode.bread(self.file_path)
+        self._load()
+
+    @classmethod
+    def _from_scandir(cls, entry: os.DirEntry, raw: Optional[bytes] = None):
+        """
+        Create a FastResume from an os.scandir entry of an absolute directory path, and optionally
+        the file's contents if the caller has already read them.
+        scandir has already established the file exists and is a regular file, so the
+        exists/isfile checks done by __init__ are skipped, and realpath is only needed for symlinks.
+        """
+        fast_resume = cls.__new__(cls)
+        fast_resume._file_path = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+        fast_resume._load(raw)
+        return fast_resume
+
+    def _load(self, raw: Optional[bytes] = None):
+        self.logger.debug('Loading Fast Resume: %s', self.file_path)
+        if raw is None:
+            raw = _read_bytes(self.file_path)
+        self._data = _bdecode(raw)
+        if not isinstance(self._data, dict):
+            raise ValueError('Not a valid qBittorrent .fastresume file')
         if 'save_path' not in self._data or 'qBt-savePath' not in self._data:
             raise ValueError('Missing required keys for a qBittorrent .fastresume file')
-        self.logger.debug(f'Fast Resume ({self.file_path}) Init Complete.')
+        self.logger.debug('Fast Resume (%s) Init Complete.', self.file_path)
 
     @property
     def file_path(self):
@@ -140,10 +423,11 @@ class FastResume(object):
             raise KeyError('When setting a save path, key must be `save_path` or `qBt-savePath`. '
                            f'Received {key}')
         if create_backup:
-            self.save(self.backup_filename)
+            self.backup()
         if target_os is not None:
-            path = convert_slashes(path, target_os)
-        self.logger.debug(f'Setting {key}... Old: {self._data[key]}, New: {path}, Target OS: {target_os}')
+            path = slash_converter(target_os)(path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Setting %s... Old: %s, New: %s, Target OS: %s', key, self._data[key], path, target_os)
         self._data[key] = path
         if save_file:
             self.save()
@@ -151,27 +435,85 @@ class FastResume(object):
     def set_save_paths(self, path: str, target_os: Optional[str] = None,
                        save_file: bool = True, create_backup: bool = True):
         if create_backup:
-            self.save(self.backup_filename)
+            self.backup()
         self.set_save_path(path, key='save_path', target_os=target_os, save_file=False, create_backup=False)
         self.set_save_path(path, key='qBt-savePath', target_os=target_os, save_file=False, create_backup=False)
         if self.mapped_files is not None and target_os is not None:
             self.logger.debug('Converting Slashes for mapped_files...')
-            self._data['mapped_files'] = [convert_slashes(path, target_os) for path in self.mapped_files]
+            convert = slash_converter(target_os)
+            self._data['mapped_files'] = [convert(path) for path in self.mapped_files]
         if save_file:
             self.save()
 
-    def save(self, file_name: Optional[str] = None):
+    def _set_paths(self, save_path: Optional[str], qbt_save_path: Optional[str], target_os: Optional[str] = None):
+        """
+        Set save_path and/or qBt-savePath to paths already converted for target_os (None leaves that key alone),
+        and convert mapped_files slashes, in memory. Internal fast path for replace_paths; unlike set_save_paths
+        it does no validation, backup, or saving.
+        """
+        data = self._data
+        if target_os is not None and 'mapped_files' in data:
+            convert = slash_converter(target_os)
+            data['mapped_files'] = [convert(mapped_file) for mapped_file in data['mapped_files']]
+        if save_path is not None:
+            data['save_path'] = save_path
+        if qbt_save_path is not None:
+            data['qBt-savePath'] = qbt_save_path
+
+    def backup(self):
+        """
+        Copy the .fastresume file on disk to backup_filename, without re-encoding it.
+        """
+        backup_filename = self.backup_filename
+        self.logger.info('Backing up File %s to %s...', self.file_path, backup_filename)
+        shutil.copyfile(self.file_path, backup_filename)
+
+    def save(self, file_name: Optional[str] = None, sync: bool = False):
+        """
+        Save the FastResume. The file is written to a temporary file first and then moved into place.
+        :param file_name: File to save to. Defaults to the file this FastResume was loaded from.
+        :type file_name: str
+        :param sync: fsync the file before moving it into place
+        :type sync: bool
+        """
         if file_name is None:
             file_name = self.file_path
-        self.logger.info(f'Saving File {file_name}...')
-        bencode.bwrite(self._data, file_name)
+        self.logger.info('Saving File %s...', file_name)
+        _replace_file(file_name, _bencode(self._data), sync)
 
-    def replace_paths(self, existing_path: str, new_path: str, target_os: Optional[str] = None,
-                      save_file: bool = True, create_backup: bool = True):
-        self.logger.info(f'Replacing Paths in FastResume {self.file_path}...')
-        new_save_path = self.save_path.replace(existing_path, new_path)
-        self.logger.debug(f'Existing Save Path: {existing_path}, New Save Path: {new_path}, '
-                          f'Replaced Save Path: {new_save_path}')
-        self.set_save_paths(path=str(new_save_path), target_os=target_os,
-                            save_file=save_file, create_backup=create_backup)
-        self.logger.info(f'FastResume ({self.file_path}) Paths Replaced!')
+    def replace_paths(self, existing_path: Union[str, List[str]], new_path: Union[str, List[str]],
+                      target_os: Optional[str] = None, save_file: bool = True, create_backup: bool = True,
+                      sync: bool = False):
+        """
+        Replace existing_path with new_path in whichever of save_path and qBt-savePath contain it.
+        Given lists of paths, each key is matched against all of them, so the two keys can be moved
+        by different pairs. Does nothing when neither key contains an existing path.
+        :param existing_path: Existing path(s) to look for
+        :type existing_path: str or list[str]
+        :param new_path: New Path(s) to replace with, in the same order as existing_path
+        :type new_path: str or list[str]
+        :param target_os: If targeting a different OS than the source. Must be Windows, Linux, or Mac.
+        :type target_os: str
+        :param save_file: Save the file after replacing paths
+        :type save_file: bool
+        :param create_backup: Back up the file before replacing paths
+        :type create_backup: bool
+        :param sync: fsync the file before it replaces the original
+        :type sync: bool
+        """
+        existing_paths, new_paths = _paired_paths(existing_path, new_path)
+        new_save_path = _replaced_save_path(self.save_path, existing_paths, new_paths, target_os)
+        new_qbt_save_path = _replaced_save_path(self.qbt_save_path, existing_paths, new_paths, target_os)
+        if new_save_path is None and new_qbt_save_path is None:
+            self.logger.debug('%s not in FastResume %s, nothing to replace.',
+                              ', '.join(existing_paths), self.file_path)
+            return
+        self.logger.info('Replacing Paths in FastResume %s...', self.file_path)
+        self.logger.debug('Existing Path: %s, New Path: %s, Replaced Save Path: %s, Replaced qBt Save Path: %s',
+                          existing_path, new_path, new_save_path, new_qbt_save_path)
+        if create_backup:
+            self.backup()
+        self._set_paths(new_save_path, new_qbt_save_path, target_os)
+        if save_file:
+            self.save(sync=sync)
+        self.logger.info('FastResume (%s) Paths Replaced!', self.file_path)
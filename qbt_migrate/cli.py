@@ -2,15 +2,30 @@ import logging
 import argparse
 
 from . import QBTBatchMove, discover_bt_backup_path
+from .classes import DEFAULT_MAX_WORKERS
 
 
 logger = logging.getLogger(__name__)
 
 
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('Must be a whole number of at least 1. Received: %s' % value)
+    return number
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-e', '--existing-path', help='Existing root of path to look for.')
-    parser.add_argument('-n', '--new-path', help='New root path to replace existing root path with.')
+    parser.add_argument('-e', '--existing-path', help='Existing root of path to look for. '
+                                                      'Can be given multiple times, paired in order with -n.',
+                        action='append')
+    parser.add_argument('-n', '--new-path', help='New root path to replace existing root path with. '
+                                                 'Can be given multiple times, paired in order with -e.',
+                        action='append')
     parser.add_argument('-t', '--target-os', help='Target OS (converts slashes). '
                                                   'Default will auto-detect if conversion is needed '
                                                   'based on existing vs new.',
@@ -20,6 +35,13 @@ def parse_args():
     parser.add_argument('-s', '--skip-bad-files', help='Skips bad .fastresume files instead of exiting. '
                                                        'Default behavior is to exit.',
                         action='store_true', default=False)
+    parser.add_argument('--no-backup', help='Skip creating the backup zip archive of the BT_Backup directory. '
+                                            'Each .fastresume file is then fsynced before it replaces the original.',
+                        action='store_true', default=False)
+    parser.add_argument('-w', '--max-workers', help='Maximum number of .fastresume files to process concurrently. '
+                                                    'Use 8-32 for SSDs, 2-4 for HDDs. '
+                                                    'Default is %(default)s.',
+                        type=_positive_int, default=DEFAULT_MAX_WORKERS)
 
     parser.add_argument('-l', '--log-level', help='Log Level, Default is INFO.',
                         choices=['DEBUG', 'INFO'], default='INFO')
@@ -33,7 +55,7 @@ def main():
     logger.setLevel(args.log_level)
     logging.getLogger('qbt_migrate').setLevel(args.log_level)
     logging.getLogger('qbt_migrate').propagate = True
-    qbm = QBTBatchMove()
+    qbm = QBTBatchMove(max_workers=args.max_workers)
     if args.bt_backup_path is not None:
         qbm.bt_backup_path = args.bt_backup_path
     else:
@@ -41,23 +63,28 @@ def main():
         if bt_backup_path.strip():
             qbm.bt_backup_path = bt_backup_path
     if args.existing_path is None:
-        args.existing_path = input('Existing Path: ')
+        args.existing_path = [input('Existing Path: ')]
     if args.new_path is None:
-        args.new_path = input('New Path: ')
+        args.new_path = [input('New Path: ')]
+    if len(args.existing_path) != len(args.new_path):
+        raise ValueError('Each existing path (-e) must have a new path (-n).')
     if args.target_os is None:
         args.target_os = input('Target OS (Windows, Linux, Mac, Blank for auto-detect): ')
     if args.target_os.strip() and args.target_os.lower() not in ('windows', 'linux', 'mac'):
         raise ValueError('Target OS is not valid. Must be Windows, Linux, or Mac. Received: %s' % args.target_os)
     elif not args.target_os.strip():
-        if '/' in args.existing_path and '\\' in args.new_path:
+        if all('/' in existing_path and '\\' in new_path
+               for existing_path, new_path in zip(args.existing_path, args.new_path)):
             logger.info('Auto detected target OS change. Will convert slashes to Windows.')
             args.target_os = 'windows'
-        elif '\\' in args.existing_path and '/' in args.new_path:
+        elif all('\\' in existing_path and '/' in new_path
+                 for existing_path, new_path in zip(args.existing_path, args.new_path)):
             logger.info('Auto detected target OS change. Will convert slashes to Linux/Mac.')
             args.target_os = 'linux'
         else:
             args.target_os = None
-    qbm.run(args.existing_path, args.new_path, args.target_os, args.skip_bad_files)
+    qbm.run(args.existing_path, args.new_path, args.target_os, create_backup=not args.no_backup,
+            skip_bad_files=args.skip_bad_files)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+from typing import Callable
 
 
 logger = logging.getLogger(__name__)
@@ -16,11 +17,19 @@ def discover_bt_backup_path():
     return os.path.join(os.getenv('HOME'), '.local/share/data/qBittorrent/BT_backup')
 
 
+_SLASH_CONVERTERS = {
+    'windows': lambda path: path.replace('/', '\\'),
+    'linux': lambda path: path.replace('\\', '/'),
+    'mac': lambda path: path.replace('\\', '/'),
+}
+
+
+def slash_converter(target_os: str) -> Callable[[str], str]:
+    try:
+        return _SLASH_CONVERTERS[target_os.lower()]
+    except KeyError:
+        raise ValueError('Target OS is not valid. Must be Windows, Linux, or Mac. Received: %s' % target_os) from None
+
+
 def convert_slashes(path: str, target_os: str):
-    if target_os.lower() not in ('windows', 'linux', 'mac'):
-        raise ValueError('Target OS is not valid. Must be Windows, Linux, or Mac. Received: %s' % target_os)
-    if target_os.lower() == 'windows':
-        logger.debug('Convert to Windows Slashes')
-        return path.replace('/', '\\')
-    logger.debug('Convert to Unix Slashes')
-    return path.replace('\\', '/')
+    return slash_converter(target_os)(path)
@@ -14,6 +14,9 @@ setup(
     version='2.1.0',
     packages=find_packages(),
     install_requires=dependencies,
+    extras_require={
+        'fast': ['fastbencode']
+    },
     description='Migrate qBittorrent FastResume files.',
     long_description=long_description,
     long_description_content_type='text/markdown',
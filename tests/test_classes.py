@@ -0,0 +1,253 @@
+import os
+import errno
+import asyncio
+import stat
+import shutil
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+import bencode
+
+from qbt_migrate import classes
+from qbt_migrate.classes import FastResume, QBTBatchMove
+
+
+class BTBackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bt_backup_path = os.path.join(self.tmp_dir, 'BT_backup')
+        os.mkdir(self.bt_backup_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_fast_resume(self, name: str, save_path: str, qbt_save_path: str = None, **extra) -> str:
+        data = {
+            'mapped_files': ['Season 1/Episode 1.mkv'],
+            'pieces': b'\x01\x00\xff',
+            'qBt-savePath': save_path if qbt_save_path is None else qbt_save_path,
+            'save_path': save_path,
+        }
+        data.update(extra)
+        path = os.path.join(self.bt_backup_path, name + '.fastresume')
+        bencode.bwrite(data, path)
+        return path
+
+
+class TestReplaceFile(BTBackupTestCase):
+    def assertKeepsMode(self):
+        path = os.path.join(self.bt_backup_path, 'a.fastresume')
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        os.chmod(path, 0o604)
+        classes._replace_file(path, b'new')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o604)
+        self.assertEqual(os.listdir(self.bt_backup_path), ['a.fastresume'])
+
+    @unittest.skipIf(os.name == 'nt', 'File modes are not supported on Windows')
+    def test_keeps_mode(self):
+        self.assertKeepsMode()
+
+    @unittest.skipIf(os.name == 'nt', 'File modes are not supported on Windows')
+    def test_keeps_mode_without_tmpfile(self):
+        with mock.patch.object(classes, '_link_tmpfile', return_value=False):
+            self.assertKeepsMode()
+
+    @unittest.skipUnless(hasattr(os, 'O_TMPFILE'), 'O_TMPFILE is only available on Linux')
+    def test_tmpfile_disabled_only_when_unsupported(self):
+        path = os.path.join(self.bt_backup_path, 'a.fastresume.tmp')
+        for error, supported in ((errno.EMFILE, True), (errno.ENOSPC, True), (errno.EOPNOTSUPP, False)):
+            with self.subTest(error=errno.errorcode[error]), \
+                    mock.patch.object(classes, '_tmpfile_supported', True), \
+                    mock.patch.object(classes.os, 'open', side_effect=OSError(error, os.strerror(error))):
+                self.assertFalse(classes._link_tmpfile(path, b'new'))
+                self.assertEqual(classes._tmpfile_supported, supported)
+
+
+class TestQBTBatchMove(BTBackupTestCase):
+    def test_backup_folder(self):
+        contents = {
+            'a.fastresume': b'd9:save_path3:/abe',
+            'empty.fastresume': b'',
+            'large.torrent': os.urandom(3 * 1024 * 1024),
+        }
+        for name, data in contents.items():
+            with open(os.path.join(self.bt_backup_path, name), 'wb') as f:
+                f.write(data)
+        archive_path = os.path.join(self.tmp_dir, 'backup.zip')
+        QBTBatchMove.backup_folder(self.bt_backup_path, archive_path, max_workers=2)
+        with zipfile.ZipFile(archive_path) as archive:
+            self.assertIsNone(archive.testzip())
+            members = {os.path.basename(name): archive.read(name) for name in archive.namelist()}
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()))
+        self.assertEqual(members, contents)
+
+    def test_backup_folder_skips_archive_in_folder(self):
+        self.write_fast_resume('a', '/mnt/disk1')
+        archive_path = os.path.join(self.bt_backup_path, 'backup.zip')
+        QBTBatchMove.backup_folder(self.bt_backup_path, archive_path)
+        with zipfile.ZipFile(archive_path) as archive:
+            self.assertEqual([os.path.basename(name) for name in archive.namelist()], ['a.fastresume'])
+
+    def test_run_multiple_paths(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        self.write_fast_resume('b', '/mnt/disk10/Torrents')
+        self.write_fast_resume('c', '/mnt/other')
+        QBTBatchMove(self.bt_backup_path).run(['/mnt/disk1', '/mnt/disk10'], ['/pool/one', '/pool/ten'],
+                                              create_backup=False)
+        save_paths = {name: bencode.bread(os.path.join(self.bt_backup_path, name + '.fastresume'))['save_path']
+                      for name in 'abc'}
+        self.assertEqual(save_paths, {'a': '/pool/one/Torrents', 'b': '/pool/ten/Torrents', 'c': '/mnt/other'})
+
+    def test_run_fsyncs_archive_before_rewriting(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        calls = mock.Mock()
+        with mock.patch.object(classes.os, 'fsync', wraps=os.fsync) as fsync, \
+                mock.patch.object(classes, '_replace_file', wraps=classes._replace_file) as replace_file:
+            calls.attach_mock(fsync, 'fsync')
+            calls.attach_mock(replace_file, 'replace_file')
+            QBTBatchMove(self.bt_backup_path).run('/mnt/disk1', '/mnt/disk2')
+        names = [name for name, _, _ in calls.mock_calls]
+        # Files are not fsynced when there is a backup archive, so any fsync before the rewrite is the archive's
+        self.assertIn('replace_file', names)
+        self.assertLess(names.index('fsync'), names.index('replace_file'))
+
+    def test_run_with_backup_does_not_fsync_files(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        with mock.patch.object(classes, '_replace_file', wraps=classes._replace_file) as replace_file, \
+                mock.patch.object(classes, '_fsync_directory') as fsync_directory:
+            QBTBatchMove(self.bt_backup_path).run('/mnt/disk1', '/mnt/disk2')
+        self.assertFalse(replace_file.call_args[0][2])
+        self.assertNotIn(mock.call(self.bt_backup_path), fsync_directory.call_args_list)
+
+    def test_run_multiple_paths_per_file(self):
+        self.write_fast_resume('a', '/mnt/disk1/x', '/mnt/disk2/x')
+        QBTBatchMove(self.bt_backup_path).run(['/mnt/disk1', '/mnt/disk2'], ['/p1', '/p2'], create_backup=False)
+        data = bencode.bread(os.path.join(self.bt_backup_path, 'a.fastresume'))
+        self.assertEqual(data['save_path'], '/p1/x')
+        self.assertEqual(data['qBt-savePath'], '/p2/x')
+
+    def test_run_duplicate_existing_paths(self):
+        with self.assertRaises(ValueError):
+            QBTBatchMove(self.bt_backup_path).run(['/mnt/disk1', '/mnt/disk1'], ['/a', '/b'])
+
+    def test_run_async(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(QBTBatchMove(self.bt_backup_path).run_async('/mnt/disk1', '/mnt/disk2'))
+        finally:
+            loop.close()
+        self.assertEqual(bencode.bread(os.path.join(self.bt_backup_path, 'a.fastresume'))['save_path'],
+                         '/mnt/disk2/Torrents')
+        self.assertTrue(any(name.startswith('fastresume_backup') for name in os.listdir(self.tmp_dir)))
+
+    def test_discover_reads_each_file_once(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        self.write_fast_resume('b', '/mnt/other')
+        with mock.patch.object(classes, '_read_bytes', wraps=classes._read_bytes) as read_bytes:
+            discovered = list(QBTBatchMove.discover_relevant_fast_resume(self.bt_backup_path, '/mnt/disk1'))
+        self.assertEqual([os.path.basename(fast_resume.file_path) for fast_resume in discovered], ['a.fastresume'])
+        self.assertEqual(read_bytes.call_count, 2)
+
+    def test_discover_file_removed_after_scandir(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        removed = self.write_fast_resume('b', '/mnt/disk1/Torrents')
+        read_bytes = classes._read_bytes
+
+        def remove_then_read(path):
+            if path == removed and os.path.exists(removed):
+                os.remove(removed)
+            return read_bytes(path)
+
+        with mock.patch.object(classes, '_read_bytes', side_effect=remove_then_read):
+            discovered = list(QBTBatchMove.discover_relevant_fast_resume(self.bt_backup_path, '/mnt/disk1',
+                                                                         raise_on_error=False))
+        self.assertEqual([os.path.basename(fast_resume.file_path) for fast_resume in discovered], ['a.fastresume'])
+
+        self.write_fast_resume('b', '/mnt/disk1/Torrents')
+        with mock.patch.object(classes, '_read_bytes', side_effect=remove_then_read):
+            with self.assertRaises(FileNotFoundError):
+                list(QBTBatchMove.discover_relevant_fast_resume(self.bt_backup_path, '/mnt/disk1'))
+
+    @unittest.skipIf(os.name == 'nt', 'Creating symlinks requires privileges on Windows')
+    def test_run_follows_symlinks(self):
+        target = os.path.join(self.tmp_dir, 'a.fastresume')
+        shutil.move(self.write_fast_resume('a', '/mnt/disk1/Torrents'), target)
+        link = os.path.join(self.bt_backup_path, 'a.fastresume')
+        os.symlink(target, link)
+        QBTBatchMove(self.bt_backup_path).run('/mnt/disk1', '/mnt/disk2', create_backup=False)
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(bencode.bread(target)['save_path'], '/mnt/disk2/Torrents')
+
+    def test_run_without_backup_fsyncs_files(self):
+        self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        self.write_fast_resume('b', '/mnt/other')
+        with mock.patch.object(classes, '_replace_file', wraps=classes._replace_file) as replace_file, \
+                mock.patch.object(classes, '_fsync_directory') as fsync_directory:
+            QBTBatchMove(self.bt_backup_path).run('/mnt/disk1', '/mnt/disk2', create_backup=False)
+        replace_file.assert_called_once()
+        self.assertTrue(replace_file.call_args[0][2])
+        fsync_directory.assert_called_once_with(self.bt_backup_path)
+        self.assertEqual(bencode.bread(os.path.join(self.bt_backup_path, 'a.fastresume'))['save_path'],
+                         '/mnt/disk2/Torrents')
+        self.assertEqual(os.listdir(self.tmp_dir), ['BT_backup'])
+
+
+class TestFastResume(BTBackupTestCase):
+    def assertReplacePaths(self):
+        path = self.write_fast_resume('a', '/mnt/disk1/Torrents', '/mnt/other')
+        fast_resume = FastResume(path)
+        fast_resume.replace_paths('/mnt/disk1', 'D:\\', 'Windows', save_file=True, create_backup=False)
+        data = bencode.bread(path)
+        self.assertEqual(data['save_path'], 'D:\\\\Torrents')
+        self.assertEqual(data['qBt-savePath'], '/mnt/other')
+        self.assertEqual(data['mapped_files'], ['Season 1\\Episode 1.mkv'])
+        self.assertEqual(data['pieces'], b'\x01\x00\xff')
+        self.assertEqual(fast_resume.save_path, data['save_path'])
+        self.assertEqual(fast_resume.mapped_files, data['mapped_files'])
+
+    def test_replace_paths(self):
+        self.assertReplacePaths()
+
+    def test_replace_paths_without_fastbencode(self):
+        with mock.patch.object(classes, 'fastbencode', None):
+            self.assertReplacePaths()
+
+    def assertBackupOnce(self, update):
+        path = self.write_fast_resume('a', '/mnt/disk1/Torrents')
+        with open(path, 'rb') as f:
+            original = f.read()
+        fast_resume = FastResume(path)
+        with mock.patch.object(classes, '_bencode', wraps=classes._bencode) as encode, \
+                mock.patch.object(classes, '_replace_file', wraps=classes._replace_file) as replace_file:
+            update(fast_resume)
+        encode.assert_called_once()
+        replace_file.assert_called_once_with(path, mock.ANY, False)
+        backups = [name for name in os.listdir(self.bt_backup_path) if name.endswith('.bkup')]
+        self.assertEqual(len(backups), 1)
+        with open(os.path.join(self.bt_backup_path, backups[0]), 'rb') as f:
+            self.assertEqual(f.read(), original)
+        return bencode.bread(path)
+
+    def test_set_save_path_backup(self):
+        data = self.assertBackupOnce(lambda fast_resume: fast_resume.set_save_path('/mnt/disk2/Torrents'))
+        self.assertEqual(data['save_path'], '/mnt/disk2/Torrents')
+        self.assertEqual(data['qBt-savePath'], '/mnt/disk1/Torrents')
+
+    def test_set_save_paths_backup(self):
+        data = self.assertBackupOnce(lambda fast_resume: fast_resume.set_save_paths('D:/Torrents', 'Windows'))
+        self.assertEqual(data['save_path'], 'D:\\Torrents')
+        self.assertEqual(data['qBt-savePath'], 'D:\\Torrents')
+        self.assertEqual(data['mapped_files'], ['Season 1\\Episode 1.mkv'])
+
+    def test_replace_paths_no_match(self):
+        path = self.write_fast_resume('a', '/mnt/other')
+        mtime = os.stat(path).st_mtime_ns
+        FastResume(path).replace_paths('/mnt/disk1', '/mnt/disk2', create_backup=True)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        self.assertEqual(os.listdir(self.bt_backup_path), ['a.fastresume'])
@@ -0,0 +1,56 @@
+import sys
+import unittest
+from unittest import mock
+
+from qbt_migrate import cli
+
+
+class TestParseArgs(unittest.TestCase):
+    def parse_args(self, *args: str):
+        with mock.patch.object(sys, 'argv', ['qbt_migrate', *args]):
+            return cli.parse_args()
+
+    def test_defaults(self):
+        args = self.parse_args()
+        self.assertIsNone(args.existing_path)
+        self.assertIsNone(args.new_path)
+        self.assertFalse(args.no_backup)
+        self.assertEqual(args.max_workers, cli.DEFAULT_MAX_WORKERS)
+
+    def test_repeated_paths(self):
+        args = self.parse_args('-e', '/mnt/disk1', '-n', '/pool/one', '-e', '/mnt/disk2', '-n', '/pool/two')
+        self.assertEqual(args.existing_path, ['/mnt/disk1', '/mnt/disk2'])
+        self.assertEqual(args.new_path, ['/pool/one', '/pool/two'])
+
+    def test_no_backup_and_max_workers(self):
+        args = self.parse_args('--no-backup', '-w', '4')
+        self.assertTrue(args.no_backup)
+        self.assertEqual(args.max_workers, 4)
+
+    def test_invalid_max_workers(self):
+        for value in ('0', '-1', 'four'):
+            with self.subTest(value=value), mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+                self.parse_args('-w', value)
+
+
+class TestMain(unittest.TestCase):
+    def main(self, *args: str):
+        with mock.patch.object(sys, 'argv', ['qbt_migrate', '-b', '/tmp/BT_backup', '-t', 'Linux', *args]), \
+                mock.patch.object(cli, 'QBTBatchMove') as batch_move:
+            cli.main()
+        return batch_move
+
+    def test_main(self):
+        batch_move = self.main('-e', '/mnt/disk1', '-n', '/pool/one', '-e', '/mnt/disk2', '-n', '/pool/two',
+                               '--no-backup', '-w', '3')
+        batch_move.assert_called_once_with(max_workers=3)
+        batch_move.return_value.run.assert_called_once_with(['/mnt/disk1', '/mnt/disk2'], ['/pool/one', '/pool/two'],
+                                                            'Linux', create_backup=False, skip_bad_files=False)
+
+    def test_main_backup_by_default(self):
+        batch_move = self.main('-e', '/mnt/disk1', '-n', '/pool/one')
+        self.assertTrue(batch_move.return_value.run.call_args[1]['create_backup'])
+
+    def test_main_unpaired_paths(self):
+        with self.assertRaises(ValueError):
+            self.main('-e', '/mnt/disk1', '-e', '/mnt/disk2', '-n', '/pool/one')
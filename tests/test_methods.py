@@ -0,0 +1,20 @@
+import unittest
+
+from qbt_migrate.methods import convert_slashes, slash_converter
+
+
+class TestConvertSlashes(unittest.TestCase):
+    def test_windows(self):
+        self.assertEqual(convert_slashes('/mnt/disk1/Torrents\\Sub', 'Windows'), '\\mnt\\disk1\\Torrents\\Sub')
+
+    def test_linux_and_mac(self):
+        for target_os in ('Linux', 'mac'):
+            with self.subTest(target_os=target_os):
+                self.assertEqual(convert_slashes('X:\\Torrents/Sub', target_os), 'X:/Torrents/Sub')
+
+    def test_invalid_target_os(self):
+        with self.assertRaises(ValueError):
+            convert_slashes('/mnt/disk1', 'BeOS')
+
+    def test_slash_converter_is_reused(self):
+        self.assertIs(slash_converter('Windows'), slash_converter('windows'))